@@ -1,12 +1,18 @@
 import asyncio
-import io
 import os
+import threading
 from datetime import datetime, timedelta, timezone
+from typing import BinaryIO
 
 from fastapi import FastAPI, UploadFile, File, HTTPException, Depends
 from fastapi.middleware.cors import CORSMiddleware
 from pypdf import PdfReader
 
+try:
+    import pypdfium2 as pdfium
+except ImportError:
+    pdfium = None
+
 from auth import (
     authenticate_user, create_token, hash_password,
     get_current_user, require_superadmin, require_admin_or_above,
@@ -33,6 +39,28 @@ app.add_middleware(
 )
 
 rag_engine: RAGEngine | None = None
+# PDFium is not thread-safe, and uploads are parsed on executor threads.
+_pdfium_lock = threading.Lock()
+
+
+def _extract_pdf_text(fp: BinaryIO) -> str:
+    """Extracts page text with PDFium when available, falling back to pypdf."""
+    if pdfium is not None:
+        with _pdfium_lock:
+            pdf = pdfium.PdfDocument(fp)
+            try:
+                parts = []
+                for i in range(len(pdf)):
+                    page = pdf[i]
+                    textpage = page.get_textpage()
+                    parts.append(textpage.get_text_range())
+                    textpage.close()
+                    page.close()
+                return "\n".join(parts)
+            finally:
+                pdf.close()
+    reader = PdfReader(fp)
+    return "\n".join(page.extract_text() or "" for page in reader.pages)
 
 
 @app.on_event("startup")
@@ -232,10 +260,10 @@ def toggle_user(user_id: str, user=Depends(get_current_user)):
 # ================================================================
 
 @app.post("/query", response_model=QueryResponse)
-def query(req: QueryRequest, user=Depends(get_current_user)):
+async def query(req: QueryRequest, user=Depends(get_current_user)):
     if rag_engine is None:
         raise HTTPException(status_code=503, detail="Engine is still initializing.")
-    answer, sources = rag_engine.answer(
+    answer, sources = await rag_engine.answer(
         question=req.question,
         history=req.history,
         report_id=req.report_id,
@@ -249,12 +277,14 @@ async def upload_report(file: UploadFile = File(...), user=Depends(get_current_u
     if file.content_type not in ("application/pdf", "application/octet-stream"):
         raise HTTPException(status_code=400, detail="Only PDF files are supported")
     try:
-        content = await file.read()
+        await file.seek(0)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Error reading uploaded file: {e}")
     try:
-        reader = PdfReader(io.BytesIO(content))
-        full_text = "".join((page.extract_text() or "") + "\n" for page in reader.pages)
+        # Both parsers read the spooled upload file object directly, so the PDF is
+        # never loaded into a bytes object first.
+        loop = asyncio.get_running_loop()
+        full_text = await loop.run_in_executor(None, _extract_pdf_text, file.file)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Error parsing PDF: {e}")
     if not full_text.strip():
@@ -272,11 +302,13 @@ async def upload_report(file: UploadFile = File(...), user=Depends(get_current_u
         return UploadResponse(report_id=existing_id, filename=file.filename, already_existed=True)
 
     try:
-        report_id = rag_engine.ingest_report(
-            filename=file.filename,
-            text=full_text,
-            company_id=user.get("company_id"),
-            uploaded_by=user.get("user_id"),
+        report_id = await loop.run_in_executor(
+            None,
+            rag_engine.ingest_report,
+            file.filename,
+            full_text,
+            user.get("company_id"),
+            user.get("user_id"),
         )
     except Exception as e:
         import traceback; traceback.print_exc()
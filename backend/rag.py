@@ -1,19 +1,65 @@
+import asyncio
+import hashlib
 import json
+import os
+import re
+import threading
 import uuid
+from collections import OrderedDict
 from typing import List, Dict, Tuple, Optional
 
 import numpy as np
+import tiktoken
 from fastembed import TextEmbedding
-from groq import Groq
+from groq import AsyncGroq, Groq
 
-from db import get_db, init_db
+try:
+    import simsimd
+except ImportError:
+    simsimd = None
+
+from db import EMBEDDING_DIM, get_db, init_db
 from knowledge_base import KNOWLEDGE_CHUNKS
 
 EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
 CHAT_MODEL = "llama-3.3-70b-versatile"
+QUERY_CACHE_SIZE = 512
+ANSWER_CACHE_SIZE = 256
+EMBED_BATCH_SIZE = 64
+EMBEDDING_CACHE_DIR = os.getenv(
+    "EMBEDDING_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache")
+)
+# Per-request token budget for /query, chosen to bound cost and latency; it is not the
+# model's context limit (llama-3.3-70b-versatile accepts 128K). Chat history older than
+# what fits is dropped. Llama 3 has no tiktoken encoding, so counts use cl100k_base as
+# an approximation, or chars/4 if the encoding cannot be loaded.
+TOKENIZER_ENCODING = "cl100k_base"
+CHAT_TOKEN_BUDGET = 8192
+CHAT_RESPONSE_TOKENS = 1024
+MESSAGE_OVERHEAD_TOKENS = 4
+
+ANSWER_SYSTEM_PROMPT = (
+    "You are a senior building science and strata engineering advisor. "
+    "Your goal is to help PROJECT MANAGERS answer technical questions that "
+    "they would normally ask an engineer or technician.\n\n"
+    "Use ONLY the provided context from reports and knowledge base. "
+    "Be conservative; if the question requires detailed structural analysis "
+    "or legal advice, clearly say it must be escalated to an engineer.\n\n"
+    "Always:\n"
+    "- Explain in plain language first.\n"
+    "- Then add a short technical note if needed.\n"
+    "- Never give structural sign-off or legal advice."
+)
+ANSWER_SYSTEM_PROMPT_WITH_REPORT = ANSWER_SYSTEM_PROMPT + (
+    "\n\nA specific report is associated with this question. "
+    "Give priority to information coming from that report when answering."
+)
 
 _embedder: TextEmbedding | None = None
+_tokenizer: tiktoken.Encoding | None = None
+_tokenizer_unavailable = False
 client = Groq()
+async_client = AsyncGroq()
 
 
 def _get_embedder() -> TextEmbedding:
@@ -23,37 +69,151 @@ def _get_embedder() -> TextEmbedding:
     return _embedder
 
 
-def _normalize(v: np.ndarray) -> np.ndarray:
-    return v / (np.linalg.norm(v) + 1e-10)
+def _get_tokenizer() -> tiktoken.Encoding | None:
+    """Returns the tokenizer, or None if its BPE file could not be fetched (e.g. no network)."""
+    global _tokenizer, _tokenizer_unavailable
+    if _tokenizer is None and not _tokenizer_unavailable:
+        try:
+            _tokenizer = tiktoken.get_encoding(TOKENIZER_ENCODING)
+        except Exception:
+            _tokenizer_unavailable = True
+    return _tokenizer
+
+
+def _count_tokens(text: str) -> int:
+    tokenizer = _get_tokenizer()
+    if tokenizer is None:
+        return len(text) // 4 + 1 + MESSAGE_OVERHEAD_TOKENS
+    return len(tokenizer.encode(text, disallowed_special=())) + MESSAGE_OVERHEAD_TOKENS
 
 
-def _embed(texts: List[str]) -> List[np.ndarray]:
+def _embed(texts: List[str]) -> np.ndarray:
+    """Returns an (N, EMBEDDING_DIM) float32 matrix of L2-normalized rows."""
+    matrix = np.empty((len(texts), EMBEDDING_DIM), dtype="float32")
     if not texts:
-        return []
-    vectors = list(_get_embedder().embed(texts))
-    return [_normalize(np.array(v, dtype="float32")) for v in vectors]
+        return matrix
+    vectors = _get_embedder().embed(texts, batch_size=EMBED_BATCH_SIZE)
+    for i, v in enumerate(vectors):
+        matrix[i] = v
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True) + 1e-10
+    return matrix
+
+
+def _quantize(x: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Symmetric int8 quantization per row (or of a single vector): x ~= codes * scales."""
+    absmax = np.abs(x).max(axis=-1, keepdims=True)
+    scales = (absmax / 127.0 + 1e-12).astype("float32")
+    codes = np.rint(x / scales).astype(np.int8)
+    return codes, scales.ravel()
+
+
+def _load_base_index(texts: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """Loads the quantized base-corpus embeddings from disk, embedding and saving them on a cache miss.
+
+    The arrays are memory-mapped read-only, so every uvicorn worker shares one
+    copy through the page cache. The cache files are keyed by the model name
+    and corpus text, so editing the knowledge base or switching models
+    re-embeds on the next start.
+    """
+    digest = hashlib.sha1("\0".join([EMBEDDING_MODEL, *texts]).encode("utf-8")).hexdigest()[:16]
+    paths = [
+        os.path.join(EMBEDDING_CACHE_DIR, f"base_{name}-{digest}.npy")
+        for name in ("codes", "scales")
+    ]
+    try:
+        return tuple(np.load(path, mmap_mode="r") for path in paths)
+    except FileNotFoundError:
+        pass
+
+    codes, scales = _quantize(_embed(texts))
+    try:
+        os.makedirs(EMBEDDING_CACHE_DIR, exist_ok=True)
+        for path, array in zip(paths, (codes, scales)):
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, array)
+            os.replace(tmp_path, path)
+    except OSError:
+        pass  # read-only filesystem: keep serving from memory
+    return codes, scales
+
+
+def _dot_scores(
+    codes: np.ndarray, scales: np.ndarray, query_codes: np.ndarray, query_scale: np.ndarray
+) -> np.ndarray:
+    """Dequantized dot product of every int8 row with the int8 query (cosine, since rows are normalized)."""
+    if simsimd is not None:
+        raw = np.asarray(simsimd.cdist(query_codes[None, :], codes, metric="dot")).ravel()
+    else:
+        raw = codes @ query_codes.astype(np.int32)
+    return raw * (scales * query_scale)
+
+
+def _top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k highest scores, best first, in O(n + k log k)."""
+    k = min(k, scores.size)
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+    if k < scores.size:
+        idx = np.argpartition(-scores, k - 1)[:k]
+    else:
+        idx = np.arange(scores.size)
+    return idx[np.argsort(-scores[idx])]
+
+
+_SENTENCE_RE = re.compile(r"[^.!?\n]+[.!?\n]*|[.!?\n]+")
 
 
 def chunk_text(text: str, max_chars: int = 1200, overlap: int = 200) -> List[str]:
+    """Splits text into chunks of at most max_chars, breaking on sentence boundaries.
+
+    Consecutive chunks share up to `overlap` characters of whole sentences.
+    Sentences longer than max_chars are hard-split.
+    """
     text = text.replace("\r\n", "\n")
+    lengths = []
+    for m in _SENTENCE_RE.finditer(text):
+        n = m.end() - m.start()
+        lengths.extend([max_chars] * (n // max_chars))
+        if n % max_chars:
+            lengths.append(n % max_chars)
+    if not lengths:
+        return []
+
+    # Sentences tile the text, so chunk boundaries are prefix sums of their lengths.
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+
+    def chunk_end(k: int) -> int:
+        return max(int(np.searchsorted(ends, starts[k] + max_chars, side="right")), k + 1)
+
     chunks = []
-    start = 0
-    length = len(text)
-    while start < length:
-        end = min(start + max_chars, length)
-        chunks.append(text[start:end].strip())
-        if end == length:
+    i, n_sent = 0, len(lengths)
+    while i < n_sent:
+        j = chunk_end(i)
+        chunks.append(text[starts[i]:ends[j - 1]].strip())
+        if j == n_sent:
             break
-        start = end - overlap
+        # Back up into the tail of this chunk, unless the overlap would leave no room for new text.
+        next_i = int(np.searchsorted(starts, ends[j - 1] - overlap, side="left"))
+        i = next_i if i < next_i < j and chunk_end(next_i) > j else j
     return [c for c in chunks if c]
 
 
 class RAGEngine:
     def __init__(self):
         self.base_docs: List[Dict] = KNOWLEDGE_CHUNKS
-        self.base_embeddings: List[np.ndarray] = _embed(
-            [d["text"] for d in self.base_docs]
-        )
+        self.base_codes, self.base_scales = _load_base_index([d["text"] for d in self.base_docs])
+        # Load the model here, on the startup executor, even when the base index came
+        # from disk: queries embed from executor threads and _get_embedder is unlocked.
+        _get_embedder()
+        self._query_cache: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._answer_cache: "OrderedDict[Tuple[str, str, str, str], Tuple[str, List[str]]]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._system_prompt_tokens = {
+            prompt: _count_tokens(prompt)
+            for prompt in (ANSWER_SYSTEM_PROMPT, ANSWER_SYSTEM_PROMPT_WITH_REPORT)
+        }
         init_db()
 
     # ---------- REPORT INGESTION ----------
@@ -92,19 +252,41 @@ class RAGEngine:
 
     # ---------- RETRIEVAL ----------
 
+    def _embed_query(self, question: str) -> np.ndarray:
+        """Embeds a question, reusing the vector for repeats of the same normalized text."""
+        key = question.strip().lower()
+        with self._cache_lock:
+            cached = self._query_cache.get(key)
+            if cached is not None:
+                self._query_cache.move_to_end(key)
+                return cached
+
+        vec = _embed([question])[0]
+        vec.setflags(write=False)
+        with self._cache_lock:
+            self._query_cache[key] = vec
+            self._query_cache.move_to_end(key)
+            if len(self._query_cache) > QUERY_CACHE_SIZE:
+                self._query_cache.popitem(last=False)
+        return vec
+
     def _retrieve_from_pool(
         self,
         query_vec: np.ndarray,
         docs: List[Dict],
-        embeddings: List[np.ndarray],
+        codes: np.ndarray,
+        scales: np.ndarray,
         top_k: int = 3,
     ) -> List[Dict]:
-        scored = []
-        for doc, vec in zip(docs, embeddings):
-            score = float(vec @ query_vec)
-            scored.append({**doc, "score": score})
-        scored.sort(key=lambda d: d["score"], reverse=True)
-        return scored[:top_k]
+        if not docs or top_k <= 0:
+            return []
+        query_codes, query_scale = _quantize(query_vec)
+        scores = _dot_scores(codes, scales, query_codes, query_scale)
+        top_idx = _top_k_indices(scores, top_k)
+        return [
+            dict(docs[i], score=score)
+            for i, score in zip(top_idx.tolist(), scores[top_idx].tolist())
+        ]
 
     def _report_access_filter(self, report_id: str, viewer: Optional[Dict]) -> Tuple[str, tuple]:
         """Returns (WHERE clause, params) scoped by viewer role."""
@@ -121,42 +303,96 @@ class RAGEngine:
         where, params = self._report_access_filter(report_id, viewer)
         with get_db() as conn:
             with conn.cursor() as cur:
+                # The WHERE clause narrows to the report's rows via idx_chunks_report_id
+                # before any distance is computed; compute it once and order by the alias.
                 cur.execute(f"""
                     SELECT id, report_id, filename, text,
-                           1 - (embedding <=> %s) AS score
+                           embedding <=> %s AS distance
                     FROM report_chunks
                     {where}
-                    ORDER BY embedding <=> %s
+                    ORDER BY distance
                     LIMIT %s
-                """, (query_vec, *params, query_vec, top_k))
+                """, (query_vec, *params, top_k))
                 rows = cur.fetchall()
         return [
-            {"id": r[0], "report_id": r[1], "filename": r[2], "text": r[3], "score": r[4]}
+            {"id": r[0], "report_id": r[1], "filename": r[2], "text": r[3], "score": 1 - r[4]}
             for r in rows
         ]
 
     # ---------- ANSWER ----------
 
-    def answer(
+    @staticmethod
+    def _answer_cache_key(
+        question: str,
+        history: List[Dict] | None,
+        report_id: Optional[str],
+        viewer: Optional[Dict],
+    ) -> Tuple[str, str, str, str]:
+        """Key for the answer cache; report answers are also scoped to what the viewer can read."""
+        scope = ""
+        if report_id:
+            if not viewer or viewer.get("role") == "superadmin":
+                scope = "*"
+            elif viewer.get("role") == "admin":
+                scope = f"company:{viewer['company_id']}"
+            else:
+                scope = f"user:{viewer['user_id']}"
+        history_json = json.dumps(history or [], sort_keys=True, default=str)
+        return (
+            hashlib.sha1(question.encode("utf-8")).hexdigest(),
+            report_id or "",
+            hashlib.sha1(history_json.encode("utf-8")).hexdigest(),
+            scope,
+        )
+
+    @staticmethod
+    def _trim_history(history: List[Dict], budget: int) -> List[Dict]:
+        """Keeps the most recent turns that fit in `budget` tokens, dropping older ones."""
+        kept: List[Dict] = []
+        for message in reversed(history):
+            budget -= _count_tokens(str(message.get("content") or ""))
+            if budget < 0:
+                break
+            kept.append(message)
+        kept.reverse()
+        return kept
+
+    async def answer(
         self,
         question: str,
         history: List[Dict] | None = None,
         report_id: Optional[str] = None,
         viewer: Optional[Dict] = None,
     ) -> Tuple[str, List[str]]:
-        query_vec = _normalize(np.array(_embed([question])[0]))
-
-        report_results: List[Dict] = []
+        cache_key = self._answer_cache_key(question, history, report_id, viewer)
+        with self._cache_lock:
+            cached = self._answer_cache.get(cache_key)
+            if cached is not None:
+                self._answer_cache.move_to_end(cache_key)
+                answer, sources = cached
+                return answer, list(sources)
+
+        # Model inference and the pgvector lookup block, so they run on the default
+        # executor; base-corpus scoring is cheap and stays on the event loop.
+        loop = asyncio.get_running_loop()
+        query_vec = await loop.run_in_executor(None, self._embed_query, question)
+
+        report_future = None
         if report_id:
-            report_results = self._retrieve_report_chunks(query_vec, report_id, top_k=4, viewer=viewer)
+            report_future = loop.run_in_executor(
+                None, self._retrieve_report_chunks, query_vec, report_id, 4, viewer
+            )
 
         base_results = self._retrieve_from_pool(
             query_vec,
             self.base_docs,
-            self.base_embeddings,
+            self.base_codes,
+            self.base_scales,
             top_k=2,
         )
 
+        report_results: List[Dict] = await report_future if report_future else []
+
         merged = report_results + base_results
 
         if not merged:
@@ -175,24 +411,7 @@ class RAGEngine:
             else:
                 sources.append(f"{r.get('title')} (id={r.get('id')})")
 
-        system_prompt = (
-            "You are a senior building science and strata engineering advisor. "
-            "Your goal is to help PROJECT MANAGERS answer technical questions that "
-            "they would normally ask an engineer or technician.\n\n"
-            "Use ONLY the provided context from reports and knowledge base. "
-            "Be conservative; if the question requires detailed structural analysis "
-            "or legal advice, clearly say it must be escalated to an engineer.\n\n"
-            "Always:\n"
-            "- Explain in plain language first.\n"
-            "- Then add a short technical note if needed.\n"
-            "- Never give structural sign-off or legal advice."
-        )
-
-        if report_id:
-            system_prompt += (
-                "\n\nA specific report is associated with this question. "
-                "Give priority to information coming from that report when answering."
-            )
+        system_prompt = ANSWER_SYSTEM_PROMPT_WITH_REPORT if report_id else ANSWER_SYSTEM_PROMPT
 
         user_prompt = (
             f"Question from project manager:\n{question}\n\n"
@@ -203,15 +422,26 @@ class RAGEngine:
 
         messages = [{"role": "system", "content": system_prompt}]
         if history:
-            messages.extend(history)
+            budget = (
+                CHAT_TOKEN_BUDGET
+                - CHAT_RESPONSE_TOKENS
+                - self._system_prompt_tokens[system_prompt]
+                - _count_tokens(user_prompt)
+            )
+            messages.extend(self._trim_history(history, budget))
         messages.append({"role": "user", "content": user_prompt})
 
-        chat = client.chat.completions.create(
+        chat = await async_client.chat.completions.create(
             model=CHAT_MODEL,
             messages=messages,
         )
 
         answer = chat.choices[0].message.content
+        with self._cache_lock:
+            self._answer_cache[cache_key] = (answer, list(sources))
+            self._answer_cache.move_to_end(cache_key)
+            if len(self._answer_cache) > ANSWER_CACHE_SIZE:
+                self._answer_cache.popitem(last=False)
         return answer, sources
 
     def _get_report_text(self, report_id: str, max_chars: int = 20000, viewer: Optional[Dict] = None) -> Tuple[List[Dict], str]: